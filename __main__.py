@@ -34,7 +34,9 @@ Version {version}, Copyright (C) 向阳, all rights reserved.
 
 
 if __name__ == '__main__':
-    colorama.init(autoreset=True)
+    # 只修复windows控制台的ANSI支持, 不包装stdout
+    # 各处输出自行在行尾带上RESET
+    colorama.just_fix_windows_console()
     print(welcome_info)
     parser = argparse.ArgumentParser(description='综合工具')
     # 选项
@@ -52,6 +54,19 @@ if __name__ == '__main__':
         default=None,
         help='iverilog安装目录'
     )
+    # 强制重新构建
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='强制重新构建, 跳过增量构建检查'
+    )
+    # 优化等级
+    parser.add_argument(
+        '--opt-level',
+        type=int,
+        default=0,
+        help='优化等级, 大于0时减少工具输出并开启SV-2012前端'
+    )
     # 目标
     parser.add_argument(
         '--target',
@@ -19,10 +19,12 @@ Synthesize toolchain
 
 """
 
-import re
+import os
 import subprocess
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from project import Project
+from term import CYAN, RED, RESET
 
 
 class ActionBase:
@@ -39,7 +41,16 @@ class ActionBase:
     # iverilog
     iverilog_path: str
 
-    def __init__(self, tool_basepath: Optional[str]):
+    # 优化等级
+    opt_level: int
+
+    # yosys的公共参数
+    yosys_flags: List[str]
+
+    # iverilog的附加优化参数
+    iverilog_opt_flags: List[str]
+
+    def __init__(self, tool_basepath: Optional[str], opt_level: int = 0):
         basepath: str
         if tool_basepath is not None:
             basepath = tool_basepath + '/'
@@ -49,6 +60,15 @@ class ActionBase:
         self.vvp_path = f'{basepath}vvp'
         self.yosys_path = f'{basepath}yosys'
         self.iverilog_path = f'{basepath}iverilog'
+        # 优化等级
+        self.opt_level = opt_level
+        if opt_level > 0:
+            # 开启优化时减少yosys的输出开销, 并让iverilog使用SV-2012前端
+            self.yosys_flags = ['-Q', '-q']
+            self.iverilog_opt_flags = ['-g2012']
+        else:
+            self.yosys_flags = ['-Q', '-v', 'info']
+            self.iverilog_opt_flags = []
 
 
 class Actions(ActionBase):
@@ -56,25 +76,37 @@ class Actions(ActionBase):
     动作
     """
 
-    def __init__(self, path: Optional[str]):
-        super(Actions, self).__init__(path)
+    # 强制重新构建, 跳过mtime检查
+    force: bool
+
+    # 搜索目录 -> 目录下最新文件的mtime
+    _dir_mtime_cache: Dict[str, float]
+
+    def __init__(self, path: Optional[str], opt_level: int = 0, force: bool = False):
+        super(Actions, self).__init__(path, opt_level)
+        self.force = force
+        self._dir_mtime_cache = {}
 
     def make_testbench(self, project: Project, module: str) -> bool:
         """
         构建test bench
         """
-        print(f'> \033[1;36mmake_test {module}')
+        print(f'> {CYAN}make_test {module}{RESET}')
         if module not in project.files:
             # 不存在的模块
-            print(f'  \033[1;31mModule "{module}" is not exist.')
+            print(f'  {RED}Module "{module}" is not exist.{RESET}')
             return False
         if module not in project.test_bench:
             # 不存在test bench
             print(
-                f'  \033[1;31mTest bench for module "{module}" is not exist.')
+                f'  {RED}Test bench for module "{module}" is not exist.{RESET}')
             return False
         # 输出文件
         ivlg_mkout = f'{project.build_out_dir}{module}.vo'
+        # 输出比所有输入都新时跳过构建
+        if not self.force and self._testbench_up_to_date(project, module, ivlg_mkout):
+            print(f'  Output of module "{module}" is up to date.')
+            return True
         # 输入文件
         inp_file: List[str] = []
         inp_file.append(project.files[module].fullpath)
@@ -82,22 +114,131 @@ class Actions(ActionBase):
         # 调用iverilog生成仿真
         return self._iverilog_invoke(project, ['-o', ivlg_mkout], inp_file)
 
+    def _testbench_up_to_date(self, project: Project, module: str, output: str) -> bool:
+        """
+        检查test bench的输出是否比所有输入都新
+        """
+        try:
+            out_mtime = os.stat(output).st_mtime
+            # 直接输入: 模块文件和test bench文件
+            latest = os.stat(project.files[module].fullpath).st_mtime
+            tb_mtime = os.stat(project.test_bench[module].fullpath).st_mtime
+            if tb_mtime > latest:
+                latest = tb_mtime
+        except OSError:
+            # 输出不存在或输入不可访问, 重新构建
+            return False
+        # 间接输入: '-y'搜索目录下的文件, 按目录取最新mtime近似
+        search_dirs = [lib.full_path for lib in project.libs]
+        search_dirs += [ip_core.root_dir for ip_core in project.ip_cores.values()]
+        search_dirs.append(project.root_dir)
+        for search_dir in search_dirs:
+            dir_mtime = self._search_dir_max_mtime(search_dir)
+            if dir_mtime > latest:
+                latest = dir_mtime
+        return out_mtime > latest
+
+    def _search_dir_max_mtime(self, dir: str) -> float:
+        """
+        目录下最新文件的mtime, 每个目录只扫描一次
+        """
+        cached = self._dir_mtime_cache.get(dir)
+        if cached is not None:
+            return cached
+        latest = 0.0
+        for (path, _dirs, files) in os.walk(dir):
+            for file in files:
+                try:
+                    mtime = os.stat(os.path.join(path, file)).st_mtime
+                except OSError:
+                    continue
+                if mtime > latest:
+                    latest = mtime
+        self._dir_mtime_cache[dir] = latest
+        return latest
+
+    def make_testbenches(self, project: Project, modules: List[str]) -> Dict[str, bool]:
+        """
+        并行构建多个test bench
+
+        iverilog是单线程的, 各模块的构建互相独立,
+        用线程池同时跑多个iverilog进程
+        """
+        worker_cnt = min(os.cpu_count() or 1, len(modules))
+        with ThreadPoolExecutor(max_workers=worker_cnt) as pool:
+            futures = {
+                module: pool.submit(self.make_testbench, project, module)
+                for module in modules
+            }
+        # 收集各个模块的结果
+        return {module: future.result() for (module, future) in futures.items()}
+
     def synthesis(self, project: Project, output: str) -> bool:
         """
         综合
         """
-        # 命令脚本
+        # yosys自身是单线程的, 因此把文件划分成若干组,
+        # 每组在独立的yosys进程中粗综合, 最后合并为一个输出.
+        # 并行综合需要用opt_level显式启用, 默认走单进程综合
+        if self.opt_level > 0:
+            file_groups = self._partition_files(project)
+        else:
+            file_groups = []
+        if len(file_groups) <= 1:
+            # 只有一组, 直接串行综合
+            command_script = []
+            command_script += self._yosys_gen_load_script(project)
+            command_script.append('synth')
+            command_script.append(f'write_verilog {output}')
+            script_file = f'{project.build_out_dir}.syntool.ys'
+            self._yosys_write_script(script_file, command_script)
+            return self._yosys_invoke(script_file)
+        # 每组生成一个脚本, 输出到'{output}.{i}.il'
+        part_outputs: List[str] = []
+        part_scripts: List[str] = []
+        for (i, group) in enumerate(file_groups):
+            part_output = f'{output}.{i}.il'
+            command_script = []
+            for file in group:
+                command_script.append(f'read_verilog {file.fullpath}')
+            # 只跑coarse段: 'coarse:fine'从coarse开始, 到fine之前停止,
+            # 既跳过begin段的hierarchy检查(被引用的模块可能在别的组),
+            # 也不会对每组单独做fine段的techmap/abc
+            command_script.append('synth -run coarse:fine')
+            # coarse结果带$alu/$mem等cell, write_verilog输出不了, 用RTLIL
+            command_script.append(f'write_rtlil {part_output}')
+            part_outputs.append(part_output)
+            script_file = f'{project.build_out_dir}.syntool.{i}.ys'
+            self._yosys_write_script(script_file, command_script)
+            part_scripts.append(script_file)
+        # 并行执行各组
+        if not self._yosys_invoke_parallel(part_scripts):
+            return False
+        # 合并各组的输出, 检查层级, 从fine段继续综合并写出最终结果
         command_script = []
-        # 输入文件
-        command_script += self._yosys_gen_load_script(project)
-        # 进行综合
-        command_script.append('synth')
-        # 综合输出
-        script = f'write_verilog {output}'
-        command_script.append(script)
-        # 执行
-        script = '; '.join(command_script)
-        return self._yosys_invoke(script)
+        for part_output in part_outputs:
+            command_script.append(f'read_rtlil {part_output}')
+        command_script.append(f'hierarchy -check -top {project.top_module}')
+        command_script.append('synth -run fine')
+        command_script.append(f'write_verilog {output}')
+        script_file = f'{project.build_out_dir}.syntool.merge.ys'
+        self._yosys_write_script(script_file, command_script)
+        return self._yosys_invoke(script_file)
+
+    @staticmethod
+    def _partition_files(project: Project) -> List[List]:
+        """
+        把工程文件按cpu核数分组, 用于并行综合
+        """
+        files = list(project.files.values())
+        group_cnt = min(os.cpu_count() or 1, len(files))
+        if group_cnt <= 1:
+            return [files]
+        # 轮转分配到各组
+        groups: List[List] = [[] for _ in range(group_cnt)]
+        for (i, file) in enumerate(files):
+            groups[i % group_cnt].append(file)
+        return groups
 
     def _yosys_gen_load_script(self, project: Project) -> List[str]:
         """
@@ -115,63 +256,87 @@ class Actions(ActionBase):
         # ret
         return command_script
 
-    def _yosys_invoke(self, script: str) -> bool:
+    @staticmethod
+    def _yosys_write_script(script_file: str, commands: List[str]):
         """
-        调用yosys
+        把命令脚本写入文件
+        用'-s'传给yosys, 避免'-p'撑爆命令行长度限制
+        """
+        with open(script_file, 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(commands))
+            fp.write('\n')
+
+    def _yosys_invoke(self, script_file: str) -> bool:
+        """
+        调用yosys执行脚本文件
         """
         # 执行
         command = [
             self.yosys_path,
-            '-Q',
-            '-v', 'info',
-            '-p', script
+            *self.yosys_flags,
+            '-s', script_file
         ]
-        cmd_strs = ' '.join(command)
-        print('>\033[1;36m Running yosys...')
+        print(f'>{CYAN} Running yosys...{RESET}')
         try:
-            subprocess.run(command, check=True)
+            subprocess.run(command, check=True, close_fds=False)
             return True
         except subprocess.CalledProcessError:
-            print('> \033[1;31myosys exitcode is not 0.')
-            print(f'  \033[1;31mCommand: {repr(cmd_strs)}')
+            # 只在失败时才拼接命令行字符串
+            cmd_strs = ' '.join(command)
+            print(f'> {RED}yosys exitcode is not 0.{RESET}')
+            print(f'  {RED}Command: {repr(cmd_strs)}{RESET}')
         return False
 
+    def _yosys_invoke_parallel(self, script_files: List[str]) -> bool:
+        """
+        并行调用多个yosys进程, 全部成功才返回True
+        """
+        print(f'>{CYAN} Running {len(script_files)} yosys process(es)...{RESET}')
+        procs = []
+        for script_file in script_files:
+            command = [
+                self.yosys_path,
+                *self.yosys_flags,
+                '-s', script_file
+            ]
+            # 捕获stdout避免多个进程的输出交叉
+            proc = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                close_fds=False)
+            procs.append((command, proc))
+        # 依次排空输出并等待
+        result = True
+        for (command, proc) in procs:
+            (stdout, _stderr) = proc.communicate()
+            if proc.returncode != 0:
+                print(f'> {RED}yosys exitcode is not 0.{RESET}')
+                print(f'  {RED}Command: {repr(" ".join(command))}{RESET}')
+                print(stdout.decode('utf-8', 'replace'))
+                result = False
+        return result
+
     def _iverilog_invoke(self, project: Project, ext_args: List[str], file_args: List[str]) -> bool:
         """
         调用iverilog
         """
+        # 基础参数(including目录和'-y'搜索路径)由工程预先构建好, 这里直接splat
         command = [
-            self.iverilog_path
+            self.iverilog_path,
+            *self.iverilog_opt_flags,
+            *ext_args,
+            *project.iverilog_base_args,
+            *file_args
         ]
-        # 添加附加的参数
-        command += ext_args
-        # 添加including目录
-        for including_dir in project.including_dir:
-            command.append('-I')
-            command.append(including_dir)
-        # 添加库目录
-        for lib in project.libs:
-            command.append('-y')
-            command.append(lib.full_path)
-        # 添加IP核的RTL文件路径到搜索路径
-        for (ip_name, ip_core) in project.ip_cores.items():
-            command.append('-y')
-            command.append(ip_core.root_dir)
-        # 添加rtl根目录到搜索路径
-        command.append('-y')
-        command.append(project.root_dir)
-        # 添加文件路径到iverilog
-        command += file_args
-        # 命令行
-        cmd_strs = ' '.join(command)
-        print('>\033[1;36m Running iverilog...')
+        print(f'>{CYAN} Running iverilog...{RESET}')
         # 执行命令
         try:
-            subprocess.run(command, check=True)
+            subprocess.run(command, check=True, close_fds=False)
             return True
         except subprocess.CalledProcessError:
-            print('> \033[1;31miverilog exitcode is not 0.')
-            print(f'  \033[1;31mCommand: {repr(cmd_strs)}')
+            # 只在失败时才拼接命令行字符串
+            cmd_strs = ' '.join(command)
+            print(f'> {RED}iverilog exitcode is not 0.{RESET}')
+            print(f'  {RED}Command: {repr(cmd_strs)}{RESET}')
         return False
 
 
@@ -183,24 +348,36 @@ class EnviromentActions(ActionBase):
     def __init__(self, path: Optional[str]):
         super(EnviromentActions, self).__init__(path)
 
+    @staticmethod
+    def _read_banner_line(command: List[str]) -> str:
+        """
+        运行命令并只读取stdout的第一行
+        版本信息就在第一行, 不必捕获和解码全部输出
+        """
+        proc = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            first_line = proc.stdout.readline().decode('ascii', 'replace')
+        finally:
+            proc.kill()
+            proc.wait()
+        return first_line.rstrip('\r\n')
+
     def check_iverilog_enviroment(self) -> bool:
         """
         检查 iverilog 环境
         """
         # 执行iverilog -v
-        print('> \033[1;36miverilog -v')
-        ivlg_ret = subprocess.run(
-            [self.iverilog_path, '-v'], capture_output=True, encoding='utf-8')
-        # 找到"Icarus Verilog version"字串, 后面的连续数字是版本
-        reg_match = re.match(
-            r'Icarus Verilog version ([0-9]+\.[0-9]+)', ivlg_ret.stdout, flags=0)
-        if reg_match is None:
-            print('  \033[1;31miverilog command output is not be recognized.')
+        print(f'> {CYAN}iverilog -v{RESET}')
+        first_line = self._read_banner_line([self.iverilog_path, '-v'])
+        # 第一行形如"Icarus Verilog version 11.0 (...)", 前缀后面是版本
+        prefix = 'Icarus Verilog version '
+        if not first_line.startswith(prefix):
+            print(f'  {RED}iverilog command output is not be recognized.{RESET}')
             return False
         else:
             # 分割得到版本号
-            match_res: re.Match[str] = reg_match
-            iverilog_version = match_res.groups()[0]
+            iverilog_version = first_line[len(prefix):].split(' ', 1)[0]
             print(f'  iverilog version {iverilog_version}')
             return True
 
@@ -209,18 +386,14 @@ class EnviromentActions(ActionBase):
         检查 yosys 环境
         """
         # 执行yosys -v
-        print('> \033[1;36myosys -V')
-        std_out = subprocess.run(
-            [self.yosys_path, '-V'], capture_output=True, encoding='utf-8')
-        # 找到"Yosys"字串, 后面是版本
-        reg_match = re.match(
-            r'(Y|y)osys (([a-zA-Z0-9]|\.)+)', std_out.stdout, flags=0)
-        if reg_match is None:
-            print('  \033[1;31myosys command output is not be recognized.')
+        print(f'> {CYAN}yosys -V{RESET}')
+        first_line = self._read_banner_line([self.yosys_path, '-V'])
+        # 第一行形如"Yosys 0.23 (...)", "yosys"后面是版本
+        if not first_line.lower().startswith('yosys '):
+            print(f'  {RED}yosys command output is not be recognized.{RESET}')
             return False
         else:
             # 分割得到版本号
-            match_res: re.Match[str] = reg_match
-            version = match_res.groups()[1]
+            version = first_line.split(' ', 2)[1]
             print(f'  yosys version {version}')
             return True
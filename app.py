@@ -19,31 +19,36 @@ Synthesize toolchain
 
 """
 
+import sys
 import rtoml
 import subprocess
 from argparse import Namespace
+from typing import Callable, Dict
 from action import Actions, EnviromentActions
 from project import Project
+from term import CYAN, RED, YELLOW, RESET
 
 
 def _load_project(prj_file: str) -> Project:
     """
     载入工程
     """
-    print(f'> \033[1;36mload project: {prj_file}')
-    prj = Project(prj_file)
-    # 工程信息
-    print('  language: \033[1;33m' + prj.language)
-    print('  top module: \033[1;33m' + prj.top_module)
-    print(f'  found \033[1;33m{len(prj.files)}\033[0m RTL file(s)')
-    print(
-        f'  found \033[1;33m{len(prj.test_bench)}\033[0m RTL TestBench file(s)')
-    print(f'  found \033[1;33m{len(prj.ip_cores)}\033[0m IP core(s)')
+    print(f'> {CYAN}load project: {prj_file}{RESET}')
+    prj = Project.load_cached(prj_file)
+    # 工程信息, 拼成一段后一次性写出
+    info_lines = [
+        f'  language: {YELLOW}{prj.language}{RESET}',
+        f'  top module: {YELLOW}{prj.top_module}{RESET}',
+        f'  found {YELLOW}{len(prj.files)}{RESET} RTL file(s)',
+        f'  found {YELLOW}{len(prj.test_bench)}{RESET} RTL TestBench file(s)',
+        f'  found {YELLOW}{len(prj.ip_cores)}{RESET} IP core(s)'
+    ]
+    sys.stdout.write('\n'.join(info_lines) + '\n')
     #
     return prj
 
 
-def _check_enviroment(action: EnviromentActions, project_file: str) -> bool:
+def _check_enviroment(action: EnviromentActions, load_project: Callable[[], Project]) -> bool:
     """
     检查环境
     """
@@ -53,27 +58,35 @@ def _check_enviroment(action: EnviromentActions, project_file: str) -> bool:
         # 检查yosys
         action.check_yosys_enviroment()
         # 检查工程文件是否合法
-        _load_project(project_file)
+        prj = load_project()
+        # 强制解析spec文件, 惰性求值不能让check漏掉它的错误
+        _ = (prj.libs, prj.including_dir)
         return True
     except FileNotFoundError:
         print(
-            '  \033[1;31mTools was not found, did your forget add it to PATH?')
+            f'  {RED}Tools was not found, did your forget add it to PATH?{RESET}')
     except rtoml.TomlParsingError as e:
-        print(f'  \033[1;31mProject file is invaild: {e}')
+        print(f'  {RED}Project file is invaild: {e}{RESET}')
     except AttributeError as e:
-        print(f'  \033[1;31mProject file missing one or more keys: {e}')
+        print(f'  {RED}Project file missing one or more keys: {e}{RESET}')
     except Exception as e:
-        print(f'  \033[1;31mLoading project cause an exception: {e}')
+        print(f'  {RED}Loading project cause an exception: {e}{RESET}')
     return False
 
 
-def _make_simu(action: Actions, project_file: str, top_module: str) -> bool:
+def _make_simu(action: Actions, prj: Project, top_module: str) -> bool:
     """
     构建仿真文件
+
+    target可以是','分隔的多个模块, 此时并行构建
     """
-    # 载入工程
-    prj = _load_project(project_file)
-    # 构建
+    if top_module is None:
+        # 没有--target, 走make_testbench的"模块不存在"报错路径
+        return action.make_testbench(prj, top_module)
+    modules = top_module.split(',')
+    if len(modules) > 1:
+        results = action.make_testbenches(prj, modules)
+        return all(results.values())
     return action.make_testbench(prj, top_module)
 
 
@@ -84,31 +97,31 @@ def _dump_wave(action: Actions, prj: Project, top_module: str) -> bool:
     vvp = action.vvp_path
     # 仿真输出
     ivlg_mkout = f'{prj.build_out_dir}{top_module}.vo'
-    print('>\033[1;36m Running vvp...')
+    print(f'>{CYAN} Running vvp...{RESET}')
     subprocess.run([vvp, '-n', ivlg_mkout], check=True)
     return True
 
 
-def _simu(action: Actions, project_file: str, top_module: str) -> bool:
+def _simu(action: Actions, prj: Project, top_module: str) -> bool:
     """
     进行仿真
     """
-    # 载入工程
-    prj = _load_project(project_file)
     # 构建
-    if not action.make_testbench(prj, top_module):
+    if not _make_simu(action, prj, top_module):
         return False
-    # 仿真
-    return _dump_wave(action, prj, top_module)
+    # 仿真, 多个模块时逐个dump波形
+    # (没有--target时构建已经失败, 这里不会拿到None)
+    modules = top_module.split(',') if top_module is not None else []
+    for module in modules:
+        if not _dump_wave(action, prj, module):
+            return False
+    return True
 
 
-def _synth(action: Actions, project_file: str, output: str) -> bool:
+def _synth(action: Actions, prj: Project, output: str) -> bool:
     """
     进行综合
     """
-    # 载入工程
-    prj = _load_project(project_file)
-    # 综合
     return action.synthesis(prj, output)
 
 
@@ -117,25 +130,33 @@ def app_start(args: Namespace):
     启动应用程序
     """
     project: str = args.project
-    prj_action = Actions(args.basepath)
+    prj_action = Actions(args.basepath, args.opt_level, args.force)
     env_action = EnviromentActions(args.basepath)
+    # 工程按需载入一次, 各个动作间共享, 避免重复解析
+    loaded: Dict[str, Project] = {}
+
+    def load_once() -> Project:
+        if 'prj' not in loaded:
+            loaded['prj'] = _load_project(project)
+        return loaded['prj']
+
     # 支持的动作
     active = {
-        'check': lambda: _check_enviroment(env_action, project),
-        'simu': lambda: _simu(prj_action, project, args.target),
-        'synth': lambda: _synth(prj_action, project, args.target),
-        'make_simu': lambda: _make_simu(prj_action, project, args.target),
+        'check': lambda: _check_enviroment(env_action, load_once),
+        'simu': lambda: _simu(prj_action, load_once(), args.target),
+        'synth': lambda: _synth(prj_action, load_once(), args.target),
+        'make_simu': lambda: _make_simu(prj_action, load_once(), args.target),
     }
     res = False
     if args.active in active:
         res = active[args.active]()
     else:
-        print(f'> \033[1;31mBuild action "{args.active}" is invaild.')
+        print(f'> {RED}Build action "{args.active}" is invaild.{RESET}')
     # 检查情况
     if res:
         print(
-            f'> \033[1;36mMake target "{args.target}" (action="{args.active}") successed.')
+            f'> {CYAN}Make target "{args.target}" (action="{args.active}") successed.{RESET}')
     else:
         print(
-            f'> \033[1;31mMake target "{args.target}" (action="{args.active}") failed.')
+            f'> {RED}Make target "{args.target}" (action="{args.active}") failed.{RESET}')
         exit(-1)
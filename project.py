@@ -21,13 +21,22 @@ Synthesize toolchain
 
 import os
 import re
+import pickle
+import hashlib
+import functools
 import rtoml
-from typing import Dict, Any, List, Callable
+from typing import Dict, Any, List, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
+from term import RED, RESET
 
 
-@dataclass
+# '\\' -> '/' 的转换表, 预先构建一次
+_SEP_TBL = str.maketrans('\\', '/')
+
+
+@dataclass(slots=True, frozen=True)
 class FileInfo:
     # 文件名(不包括后缀)
     filename: str
@@ -39,7 +48,7 @@ class FileInfo:
     fullpath: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class IpCoreInfo:
     # 名称
     name: str
@@ -51,7 +60,7 @@ class IpCoreInfo:
     rtl_files: Dict[str, FileInfo]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class LibInfo:
     # 名称
     name: str
@@ -60,6 +69,62 @@ class LibInfo:
     full_path: str
 
 
+@dataclass(slots=True, frozen=True)
+class ProjectToml:
+    """
+    工程文件[project]段的类型化数据
+    """
+
+    # 项目语言
+    language: str
+
+    # 顶层模块
+    top_module: str
+
+    # RTL文件目录
+    rtl_dir: str
+
+    # RTL文件的匹配模式
+    rtl_dir_pattern: str
+
+    # test bench目录
+    tb_dir: str
+
+    # test bench文件的匹配模式
+    tb_dir_pattern: str
+
+    # test bench文件名格式
+    tb_file_fmt: str
+
+    # 构建输出目录
+    build_dir: str
+
+    # 工程特化的描述文件, 可选
+    spec: Optional[str]
+
+    # 必选的键, 和字段顺序一致
+    _REQUIRED_KEYS = (
+        'language', 'top_module',
+        'rtl_dir', 'rtl_dir_pattern',
+        'tb_dir', 'tb_dir_pattern', 'tb_file_fmt',
+        'build_dir'
+    )
+
+    @staticmethod
+    def from_dict(dat: Dict[str, Any]) -> 'ProjectToml':
+        """
+        从toml解析出的dict构造, 缺失的键一次性全部报告
+        """
+        missing = [key for key in ProjectToml._REQUIRED_KEYS if key not in dat]
+        if missing:
+            raise AttributeError(
+                f'Project file was missing item(s): {", ".join(missing)}.')
+        return ProjectToml(
+            *(dat[key] for key in ProjectToml._REQUIRED_KEYS),
+            dat.get('spec')
+        )
+
+
 class Project:
     """
     项目数据
@@ -96,45 +161,43 @@ class Project:
         try:
             # 解析toml
             toml_dat = rtoml.load(Path(file))
-            toml_prj_dat = toml_dat['project']
-            self._load_project_properties(toml_prj_dat)
-            # 遍历test bench文件
+            toml_prj = ProjectToml.from_dict(toml_dat['project'])
+            self.language = toml_prj.language
+            self.top_module = toml_prj.top_module
+            self.root_dir = os.path.abspath(toml_prj.rtl_dir)
+            # 各个目录的遍历互相独立, 收集后并行执行
+            # rtl文件
+            self.files: Dict[str, FileInfo] = {}
             # 测试文件名 -> 文件信息
             test_bench_file: Dict[str, FileInfo] = {}
-            # 遍历添加文件
-            self._file_lists(
-                toml_prj_dat['tb_dir'],
-                toml_prj_dat['tb_dir_pattern'],
-                self._append_file_to_map_parteval(test_bench_file)
-            )
+            # 遍历任务: (目录, 模式, 目标map)
+            walk_jobs = [
+                (toml_prj.rtl_dir, toml_prj.rtl_dir_pattern, self.files),
+                (toml_prj.tb_dir, toml_prj.tb_dir_pattern, test_bench_file)
+            ]
+            # ip核的rtl文件, 每个ip核一个map
+            toml_ip_dat = toml_dat['ip'] if 'ip' in toml_dat else []
+            ip_files_list: List[Dict[str, FileInfo]] = []
+            for ip in toml_ip_dat:
+                ip_files: Dict[str, FileInfo] = {}
+                ip_files_list.append(ip_files)
+                walk_jobs.append((ip['rtl_dir'], ip['rtl_dir_pattern'], ip_files))
+            self._run_file_walks(walk_jobs)
+            # 检查顶层模块
+            self._check_top_module()
             # 检查所有的rtl文件, 确认其有一个对应的test bench
             # 然后添加到tb文件列表
-            self.test_bench = self._load_testbench_files(toml_prj_dat, test_bench_file)
+            self.test_bench = self._load_testbench_files(toml_prj, test_bench_file)
             # ip核
-            self.ip_cores: Dict[str, IpCoreInfo]
-            if 'ip' in toml_dat:
-                toml_ip_dat = toml_dat['ip']
-                self.ip_cores = self._load_ip_cores(toml_ip_dat)
-            else:
-                self.ip_cores = {}
-            # 额外的工程特定信息
-            if 'spec' in toml_prj_dat:
-                spec_file: str = toml_prj_dat['spec']
-                (self.libs, ext_including) = self._load_spec_file(spec_file)
-            else:
-                (self.libs, ext_including) = ([], [])
-            # 包含目录
-            self.including_dir = []
-            # 添加rtl源文件根目录作为including path
-            self.including_dir.append(self.root_dir)
-            # 添加ip核的rtl根目录作为including path
+            self.ip_cores = self._load_ip_cores(toml_ip_dat, ip_files_list)
+            # 额外的工程特定信息只记下路径, 首次访问libs/including_dir时才解析
+            self._spec_file = toml_prj.spec
+            # 基础包含目录: rtl源文件根目录和ip核的rtl根目录
+            self._base_including_dir = [self.root_dir]
             for (ip_name, ip_core) in self.ip_cores.items():
-                self.including_dir.append(ip_core.root_dir)
-            # 额外的包含目录
-            self.including_dir += ext_including
+                self._base_including_dir.append(ip_core.root_dir)
             # 构建输出目录
-            self.build_out_dir = os.path.abspath(
-                toml_prj_dat['build_dir']) + os.sep
+            self.build_out_dir = os.path.abspath(toml_prj.build_dir) + os.sep
             if not os.path.exists(self.build_out_dir):
                 # 创建目录
                 os.mkdir(self.build_out_dir)
@@ -143,23 +206,148 @@ class Project:
         except FileNotFoundError as e:
             raise AttributeError(f'Missing file {e.filename}.')
 
-    def _load_project_properties(self, toml_prj_dat):
+    @functools.cached_property
+    def _spec_data(self) -> tuple:
         """
-        加载工程的属性
+        spec文件的(libs, 额外包含目录), 首次访问时才解析
         """
-        self.language = toml_prj_dat['language']
-        self.top_module = toml_prj_dat['top_module']
-        self.root_dir = os.path.abspath(toml_prj_dat['rtl_dir'])
-        # 遍历rtl文件夹下的内容, 加入文件列表
-        self.files: Dict[str, FileInfo] = {}
-        # 遍历添加文件
-        self._file_lists(
-            toml_prj_dat['rtl_dir'],
-            toml_prj_dat['rtl_dir_pattern'],
-            self._append_file_to_map_parteval(self.files)
-        )
-        # 检查顶层模块
-        self._check_top_module()
+        if self._spec_file is None:
+            return ([], [])
+        try:
+            return self._load_spec_file(self._spec_file)
+        except FileNotFoundError as e:
+            raise AttributeError(f'Missing file {e.filename}.')
+
+    @functools.cached_property
+    def libs(self) -> List[LibInfo]:
+        """
+        库信息, 来自spec文件
+        """
+        return self._spec_data[0]
+
+    @functools.cached_property
+    def including_dir(self) -> List[str]:
+        """
+        包含目录, 去重并保持顺序, 避免iverilog重复扫描同一个目录
+        """
+        return list(dict.fromkeys(self._base_including_dir + self._spec_data[1]))
+
+    @functools.cached_property
+    def iverilog_base_args(self) -> tuple:
+        """
+        iverilog的'-I'/'-y'搜索路径参数, 去重后只构建一次
+
+        返回tuple, 不可变且splat开销最小, 多次invoke之间直接复用
+        """
+        args: List[str] = []
+        for including_dir in self.including_dir:
+            args.append('-I')
+            args.append(including_dir)
+        # '-y'搜索路径: 库, ip核的rtl目录, rtl根目录
+        search_dirs = [lib.full_path for lib in self.libs]
+        search_dirs += [ip_core.root_dir for ip_core in self.ip_cores.values()]
+        search_dirs.append(self.root_dir)
+        for search_dir in dict.fromkeys(search_dirs):
+            args.append('-y')
+            args.append(search_dir)
+        return tuple(args)
+
+    # 缓存格式的版本, Project的数据结构变化时递增,
+    # 避免载入旧版syntool写出的pickle
+    _CACHE_VERSION = 1
+
+    @classmethod
+    def load_cached(cls, file: str) -> 'Project':
+        """
+        载入工程, 带磁盘缓存
+
+        每个工程固定一个缓存文件, 文件里记录着写入时的缓存键
+        (工具版本 + 工程文件和RTL/TB目录下所有文件的mtime).
+        键一致时直接反序列化, 否则重新解析并覆盖写回,
+        因此缓存目录不会随源文件修改无限增长
+        """
+        cache_info = cls._cache_key(file)
+        if cache_info is None:
+            return cls(file)
+        (cache_file, cache_key) = cache_info
+        try:
+            with open(cache_file, 'rb') as fp:
+                (stored_key, cached) = pickle.load(fp)
+            if stored_key == cache_key and isinstance(cached, cls):
+                return cached
+        except (OSError, pickle.PickleError, ValueError, TypeError, EOFError, AttributeError):
+            # 缓存不存在/损坏/格式过旧, 重新解析
+            pass
+        prj = cls(file)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, 'wb') as fp:
+                pickle.dump((cache_key, prj), fp)
+        except OSError:
+            # 写入缓存失败不影响使用
+            pass
+        return prj
+
+    @staticmethod
+    def _cache_key(file: str) -> Optional[tuple]:
+        """
+        计算工程的(缓存文件路径, 缓存键), 工程文件不合法时返回None
+        """
+        try:
+            toml_dat = rtoml.load(Path(file))
+            toml_prj_dat = toml_dat['project']
+            full_path = os.path.abspath(file)
+            # 缓存键: 缓存格式版本, 工程文件路径和mtime
+            hasher = hashlib.sha1()
+            hasher.update(f'syntool-cache-v{Project._CACHE_VERSION}'.encode('ascii'))
+            hasher.update(full_path.encode('utf-8'))
+            hasher.update(str(os.stat(file).st_mtime_ns).encode('ascii'))
+            # 加上各个源文件目录下所有文件的(路径, mtime)
+            walk_dirs = [toml_prj_dat['rtl_dir'], toml_prj_dat['tb_dir']]
+            for ip in toml_dat.get('ip', []):
+                walk_dirs.append(ip['rtl_dir'])
+            for walk_dir in walk_dirs:
+                for (path, _dirs, files) in os.walk(walk_dir):
+                    for file_name in files:
+                        fullpath = os.path.join(path, file_name)
+                        hasher.update(fullpath.encode('utf-8'))
+                        hasher.update(
+                            str(os.stat(fullpath).st_mtime_ns).encode('ascii'))
+            cache_dir = os.path.join(
+                os.path.abspath(toml_prj_dat['build_dir']), '.syntool_cache')
+            # 缓存文件名只由工程路径决定, 每个工程覆盖写同一个文件
+            name = hashlib.sha1(full_path.encode('utf-8')).hexdigest()
+            return (os.path.join(cache_dir, name + '.pkl'), hasher.hexdigest())
+        except (KeyError, OSError, rtoml.TomlParsingError):
+            # 工程文件有问题时不使用缓存, 让完整解析报告错误
+            return None
+
+    @classmethod
+    def _run_file_walks(cls, walk_jobs: List[tuple]):
+        """
+        并行执行遍历任务
+
+        各个目录互相独立, 每个任务只写自己的目标map,
+        "模块已存在"的检查在遍历过程中照常生效.
+        os.scandir在syscall期间释放GIL, 遍历是I/O密集的
+        """
+        worker_cnt = min(8, len(walk_jobs))
+        if worker_cnt <= 1 or (os.cpu_count() or 1) <= 1:
+            # 单核或只有一个任务, 串行执行
+            for (dir, pattern, target_map) in walk_jobs:
+                cls._file_lists(
+                    dir, pattern, cls._append_file_to_map_parteval(target_map))
+            return
+        with ThreadPoolExecutor(max_workers=worker_cnt) as pool:
+            futures = [
+                pool.submit(
+                    cls._file_lists,
+                    dir, pattern, cls._append_file_to_map_parteval(target_map))
+                for (dir, pattern, target_map) in walk_jobs
+            ]
+            # 等待全部完成, 遍历中的异常在这里重新抛出
+            for future in futures:
+                future.result()
 
     def _check_top_module(self):
         """
@@ -167,41 +355,43 @@ class Project:
         """
         if self.top_module not in self.files:
             print(
-                f'  \033[1;31mTop module "{self.top_module}" is not exist.')
+                f'  {RED}Top module "{self.top_module}" is not exist.{RESET}')
             raise Exception()
 
-    def _load_testbench_files(self, toml_prj_dat, test_bench_files: Dict[str, FileInfo]) -> Dict[str, FileInfo]:
+    def _load_testbench_files(self, toml_prj: ProjectToml, test_bench_files: Dict[str, FileInfo]) -> Dict[str, FileInfo]:
         """
         加载test bench文件到工程
         """
         test_bench: Dict[str, FileInfo] = {}
-        for module_name, _file in self.files.items():
-            tb_fmt = toml_prj_dat['tb_file_fmt']
-            tb_module = tb_fmt.format(module_name)
+        tb_fmt = toml_prj.tb_file_fmt
+        # 常见格式形如'{}_tb', 拆出前后缀后用拼接代替format
+        # 前后缀里出现任何大括号(如'}}'转义)时退回str.format
+        (prefix, placeholder, suffix) = tb_fmt.partition('{}')
+        rest = prefix + suffix
+        use_concat = placeholder == '{}' and '{' not in rest and '}' not in rest
+        for module_name in self.files:
+            if use_concat:
+                tb_module = prefix + module_name + suffix
+            else:
+                tb_module = tb_fmt.format(module_name)
             if tb_module in test_bench_files:
                 # 存在于之前查找的tb文件中, 添加进去
-                test_bench.update({module_name: test_bench_files[tb_module]})
+                test_bench[module_name] = test_bench_files[tb_module]
         return test_bench
 
-    def _load_ip_cores(self, toml_ip_dat) -> Dict[str, IpCoreInfo]:
+    def _load_ip_cores(self, toml_ip_dat, ip_files_list: List[Dict[str, FileInfo]]) -> Dict[str, IpCoreInfo]:
         """
         加载IP核
+        ip_files_list是预先遍历好的各ip核rtl文件, 和toml_ip_dat一一对应
         """
         ip_cores = {}
-        for ip in toml_ip_dat:
+        for (ip, ip_files) in zip(toml_ip_dat, ip_files_list):
             # ip核名称
             ip_name = ip['name']
-            # 添加ip核的rtl文件
-            ip_files: Dict[str, FileInfo] = {}
-            self._file_lists(
-                ip['rtl_dir'],
-                ip['rtl_dir_pattern'],
-                self._append_file_to_map_parteval(ip_files)
-            )
             # 确认ip_name在里面是一个实实在在的模块
             if ip_name not in ip_files:
                 print(
-                    f'  \033[1;31mCannot find top module "{ip_name}" in IP core "{ip_name}".')
+                    f'  {RED}Cannot find top module "{ip_name}" in IP core "{ip_name}".{RESET}')
                 raise Exception()
             # 添加到ip核的dict
             ip_info = IpCoreInfo(
@@ -242,15 +432,12 @@ class Project:
         返回把文件添加到target_map的函数
         """
         def impl(filename: str, filepath: str, extname: str):
-            info = FileInfo(
-                fullpath=filepath,
-                ext_name=extname,
-                filename=filename
-            )
+            # 按字段顺序位置构造, 比关键字构造少一次kwargs展开
+            info = FileInfo(filename, extname, filepath)
             # 添加到map
             if info.filename in target_map:
                 print(
-                    f'  \033[1;31mModule "{info.filename}" is already exist.')
+                    f'  {RED}Module "{info.filename}" is already exist.{RESET}')
                 raise Exception()
             else:
                 target_map.update({info.filename: info})
@@ -263,19 +450,44 @@ class Project:
         遍历文件
         cont: 文件名, 文件完整路径, 文件拓展名 -> ()
         """
-        regexp = re.compile(f'\\./{pattern}')
-        # 遍历目录下所有内容
-        for path, _dir, files in os.walk(dir):
-            for file in files:
-                fullpath = os.path.join(path, file)
-                # 避免windows下'\\'
-                # win下'\\'和'/'都是不合法的文件名, 所以可以替换
-                fullpath_text = fullpath.replace('\\', '/')
-                if regexp.match(fullpath_text):
-                    # 文件符合要求
-                    # 文件拓展名, 包括那个.
-                    ext_name = os.path.splitext(fullpath)[1]
-                    # 文件名, 不带后缀
-                    file_name = os.path.basename(fullpath)[:-len(ext_name)]
-                    # 返回
-                    cont(file_name, os.path.abspath(fullpath), ext_name)
+        regexp_match = re.compile(f'\\./{pattern}').match
+        # cwd只取一次, 避免逐文件os.path.abspath的syscall
+        cwd_prefix = os.getcwd() + os.sep
+        # 用os.scandir迭代遍历, DirEntry自带路径和文件类型, 省去逐文件stat
+        dir_stack = [dir]
+        while dir_stack:
+            try:
+                entries = os.scandir(dir_stack.pop())
+            except (FileNotFoundError, NotADirectoryError):
+                # os.walk对不存在的目录静默产出空结果, 保持相同的容错
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_stack.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    fullpath = entry.path
+                    # 避免windows下'\\'
+                    # win下'\\'和'/'都是不合法的文件名, 所以可以替换
+                    fullpath_text = fullpath.translate(_SEP_TBL)
+                    if regexp_match(fullpath_text):
+                        # 文件符合要求
+                        # 用一次rfind同时取出文件名(不带后缀)和拓展名(包括那个.)
+                        name = entry.name
+                        dot = name.rfind('.')
+                        if dot >= 0:
+                            file_name = name[:dot]
+                            ext_name = name[dot:]
+                        else:
+                            file_name = name
+                            ext_name = ''
+                        # 拼接绝对路径
+                        fullpath_abs = fullpath
+                        if not os.path.isabs(fullpath_abs):
+                            if fullpath_abs[:2] in ('./', '.\\'):
+                                fullpath_abs = fullpath_abs[2:]
+                            fullpath_abs = cwd_prefix + fullpath_abs
+                        # 返回
+                        cont(file_name, fullpath_abs, ext_name)
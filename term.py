@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+"""
+Synthesize toolchain
+~~~~~~~~~~~~~~~~~~
+
+构建工具
+
+  +------------------------------+
+  |  Synthesize                   |
+  |  文件名称: term.py            |
+  |  文件作用: 终端颜色            |
+  |  创建日期: 2026-08-27         |
+  |  开发人员: 向阳               |
+  +------------------------------+
+
+ Copyright (C) 向阳, all rights reserved.
+
+"""
+
+import sys
+
+# 输出是tty时才带ANSI颜色, 重定向到文件/管道时输出纯文本
+_IS_TTY = sys.stdout.isatty()
+
+# 青色
+CYAN = '\x1b[1;36m' if _IS_TTY else ''
+
+# 红色
+RED = '\x1b[1;31m' if _IS_TTY else ''
+
+# 黄色
+YELLOW = '\x1b[1;33m' if _IS_TTY else ''
+
+# 重置
+RESET = '\x1b[0m' if _IS_TTY else ''